@@ -1,18 +1,50 @@
 import argparse
+import errno
+import io
 import json
-import multiprocessing as mp
 import os
+import queue
 import re
 import shutil
+import subprocess
 import sys
 import tarfile
+import threading
 import unicodedata
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, Future
 from datetime import date, timedelta, datetime
 from os import path, makedirs, listdir
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, NamedTuple, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+SESSION = requests.Session()
+
+# larger files are not read ahead for the tarball, but streamed from disk, to keep the memory use bounded
+TARBALL_READ_AHEAD_MAX_SIZE = 1 << 20
+
+# stores the ETag and path of every downloaded resource, in the output directory
+ETAGS_FILENAME = ".etags.json"
+
+_DATE_DIRECTORY = re.compile(r'(\d{4})-(\d{2})-(\d{2})', re.ASCII)
+_SLUG_STRIP = re.compile(r'[^\w\s-]')
+_SLUG_DASH = re.compile(r'[-\s]+')
+# deletes the same ASCII characters as _SLUG_STRIP, for use with str.translate
+_SLUG_STRIP_ASCII = str.maketrans('', '', ''.join(
+    ch for ch in map(chr, range(128)) if not (ch.isalnum() or ch.isspace() or ch in '-_')))
 
 
 def parse_args(print_args: bool = True) -> argparse.Namespace:
@@ -66,11 +98,25 @@ def parse_args(print_args: bool = True) -> argparse.Namespace:
                         default=1,
                         type=int,
                         help="number of parallel GETs to carry out (Default %(default)s for no parallel execution)")
+    parser.add_argument("--page-size", "-s",
+                        default=1000,
+                        type=int,
+                        dest="page_size",
+                        help="number of entries to request per search bundle "
+                             "(Default %(default)s, 0 for the server's default)")
+    parser.add_argument("--full", "-f",
+                        action='store_true',
+                        help="download every resource, instead of linking the resources that the server reports "
+                             "as unchanged (by ETag) to the previous backup")
+    parser.add_argument("--pretty", "-p",
+                        action='store_true',
+                        help="parse and re-indent the downloaded resources, instead of storing the response as-is")
 
     parsed_args = parser.parse_args()
 
     parsed_args.endpoint = parsed_args.endpoint.strip("/")
     parsed_args.parallel = max(parsed_args.parallel, 1)
+    parsed_args.page_size = max(parsed_args.page_size, 0)
     parsed_args.delete_days = max(parsed_args.delete_days, 0)
 
     if print_args:
@@ -80,8 +126,7 @@ def parse_args(print_args: bool = True) -> argparse.Namespace:
     return parsed_args
 
 
-@dataclass
-class BundleResponse:
+class BundleResponse(NamedTuple):
     """store the entry in a bundle GET operation
     """
     resource_id: str
@@ -91,51 +136,171 @@ class BundleResponse:
     version: str
 
 
-def perform_request_as_json(url: str, headers: List[str] = None) -> Dict[str, Any]:
-    """perform a GET request to url with headers and return the JSON representation of the response
+def parse_headers(headers: List[str] = None) -> Dict[str, str]:
+    """parse the 'Name: value' strings passed via --header into a dict
 
     Args:
-        url (str): the endpoint to query
-        headers (List[str], optional): the headers to pass to requests.get. Defaults to None.
+        headers (List[str], optional): the headers as given on the command line. Defaults to None.
 
     Raises:
-        ValueError: if the status code is not 200
+        ValueError: if a header does not contain a colon
+
+    Returns:
+        Dict[str, str]: the headers, keyed by name
+    """
+    parsed: Dict[str, str] = {}
+    for header in headers or []:
+        if ":" not in header:
+            raise ValueError(f"Header '{header}' is not of the form 'Name: value'")
+        name, value = header.split(":", 1)
+        parsed[name.strip()] = value.strip()
+    return parsed
+
+
+def configure_session(parallel: int, headers: List[str] = None, session: requests.Session = SESSION):
+    """set up the session, so that connections are kept alive and re-used across requests
+
+    Args:
+        parallel (int): the number of parallel requests, used as the size of the connection pool
+        headers (List[str], optional): the headers to send with every request. Defaults to None.
+        session (requests.Session, optional): the session to configure. Defaults to the shared SESSION.
+    """
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    # at least two connections, as the next bundle is prefetched while the current one is read
+    pool_size = max(parallel, 2)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # advertises br (and zstd) only if the modules to decode them are installed
+    session.headers.update(make_headers(accept_encoding=True))
+    session.headers.update(parse_headers(headers))
+
+
+def response_as_json(rx: requests.Response) -> Dict[str, Any]:
+    """parse the body of a response as JSON, using orjson if it is installed
+
+    Args:
+        rx (requests.Response): the response
 
     Returns:
         Dict[str, Any]: The JSON body as a Dict
     """
-    rx = requests.get(url, headers=headers)
-    if rx.status_code != 200:
-        raise ValueError(
-            f"HTTP Error {rx.status_code} getting from {url}", rx)
+    if orjson is not None:
+        return orjson.loads(rx.content)
     return rx.json()
 
 
-def get_resource_urls_from_server(fhir_endpoint: str, resource_type: str, headers: List[str] = None) \
-        -> List[BundleResponse]:
+def dump_json_pretty(obj: Any) -> bytes:
+    """serialize obj as indented JSON, using orjson if it is installed
+
+    Args:
+        obj (Any): the object to serialize
+
+    Returns:
+        bytes: the UTF-8 encoded JSON
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2).encode("utf-8")
+
+
+def get_resource_urls_from_server(fhir_endpoint: str, resource_type: str, page_size: int = 0,
+                                  session: requests.Session = SESSION) -> List[BundleResponse]:
     """get the urls of all the resources of the given type from the server. Walks through bundles!
+    The next bundle is requested in the background as soon as its link is known,
+    so that it is transferred while the current bundle is still being parsed.
 
     Args:
         fhir_endpoint (str): the endpoint
         resource_type (str): the resource type (gets included in the request url)
-        headers (List[str], optional): the headers to pass to requests.get. Defaults to None.
+        page_size (int, optional): the number of entries to request per bundle. Defaults to 0, for the server default.
+        session (requests.Session, optional): the session to use. Defaults to the shared SESSION.
 
     Returns:
         List[BundleResponse]: The parsed entries of the original bundle
     """
     request_url = f"{fhir_endpoint}/{resource_type}"
+    if page_size > 0:
+        request_url += f"?_count={page_size}"
     bundle_responses: List[BundleResponse] = []
-    next_link = request_url
 
-    while next_link:
-        print("Requesting from: ", next_link)
-        bundle_json = perform_request_as_json(next_link, headers)
-        bundle_responses += bundle_json_to_bundle_response_list(bundle_json)
-        next_link = bundle_json_get_next_link(bundle_json)
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        def request_bundle(url: str) -> Future:
+            print("Requesting from: ", url)
+            return prefetcher.submit(open_bundle, url, session)
+
+        next_bundle = request_bundle(request_url)
+        first_bundle = True
+        while next_bundle is not None:
+            with next_bundle.result() as rx:
+                if first_bundle:
+                    print(f"Accept-Encoding: {session.headers['Accept-Encoding']}, "
+                          f"Content-Encoding: {rx.headers.get('Content-Encoding')}")
+                    first_bundle = False
+                next_bundle = None
+                if ijson is not None:
+                    append = bundle_responses.append
+                    for prefix, item in iterate_bundle_items(rx.raw):
+                        if prefix == "entry.item":
+                            append(bundle_entry_to_bundle_response(item))
+                        elif next_bundle is None and item.get("relation") == "next":
+                            next_bundle = request_bundle(item["url"])
+                else:
+                    bundle_json = response_as_json(rx)
+                    next_link = bundle_json_get_next_link(bundle_json)
+                    if next_link:
+                        next_bundle = request_bundle(next_link)
+                    bundle_responses.extend(iterate_bundle_responses(bundle_json))
 
     return bundle_responses
 
 
+def open_bundle(url: str, session: requests.Session = SESSION) -> requests.Response:
+    """request a bundle, without reading the body yet
+
+    Args:
+        url (str): the url of the bundle
+        session (requests.Session, optional): the session to use. Defaults to the shared SESSION.
+
+    Raises:
+        ValueError: if the status code is not 200
+
+    Returns:
+        requests.Response: the streamed response, which decompresses the body when reading from raw
+    """
+    rx = session.get(url, stream=True, timeout=(5, 30))
+    if rx.status_code != 200:
+        rx.close()
+        raise ValueError(
+            f"HTTP Error {rx.status_code} getting from {url}", rx)
+    rx.raw.decode_content = True
+    return rx
+
+
+def iterate_bundle_items(stream) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """incrementally parse a bundle, yielding every element of the 'link' and 'entry' arrays once it is complete
+
+    Args:
+        stream: a file-like object with the bundle JSON
+
+    Returns:
+        Iterator[Tuple[str, Dict[str, Any]]]: tuples of the prefix ('link.item' or 'entry.item') and the element
+    """
+    builder = None
+    current_prefix = None
+    for prefix, event, value in ijson.parse(stream):
+        if builder is None:
+            if event == "start_map" and prefix in ("link.item", "entry.item"):
+                builder = ijson.ObjectBuilder()
+                current_prefix = prefix
+                builder.event(event, value)
+            continue
+        builder.event(event, value)
+        if event == "end_map" and prefix == current_prefix:
+            yield current_prefix, builder.value
+            builder = None
+
+
 def bundle_json_get_next_link(bundle_json: Dict[str, Any]) -> str:
     """get the 'next' link from a bundle, if it exists
 
@@ -151,55 +316,172 @@ def bundle_json_get_next_link(bundle_json: Dict[str, Any]) -> str:
     return ""
 
 
-def bundle_json_to_bundle_response_list(bundle_json: Dict[str, Any]) -> List[BundleResponse]:
+def iterate_bundle_responses(bundle_json: Dict[str, Any]) -> Iterator[BundleResponse]:
     """parse every entry in the bundle as a BundleResponse
 
     Args:
         bundle_json (Dict[str, Any]): the bundle to parse
 
     Returns:
-        List[BundleResponse]: the parsed entries
+        Iterator[BundleResponse]: the parsed entries
     """
-    if 'entry' not in bundle_json.keys():
-        return []
-    responses: List[BundleResponse] = []
-    for entry in bundle_json['entry']:
-        url = entry["fullUrl"]
-        title = entry["resource"].get("name", None)
-        canonical_url = entry["resource"]["url"]
-        version = entry["resource"].get("version", None)
-        resource_id = entry["resource"]["id"]
-        responses.append(BundleResponse(
-            resource_id,
-            title,
-            canonical_url,
-            url,
-            version))
-
-    return responses
-
-
-def download_resource(resource_type: str, r: BundleResponse, out_dir: str) -> str:
-    """download a resource from the fully-qualified url in r to out_dir
+    for entry in bundle_json.get('entry', ()):
+        yield bundle_entry_to_bundle_response(entry)
+
+
+def bundle_entry_to_bundle_response(entry: Dict[str, Any]) -> BundleResponse:
+    """parse a single entry of a bundle as a BundleResponse
 
     Args:
-        resource_type (str): the resource type, used in the output filename
+        entry (Dict[str, Any]): the entry to parse
+
+    Returns:
+        BundleResponse: the parsed entry
+    """
+    resource = entry["resource"]
+    return BundleResponse(
+        resource["id"],
+        resource.get("name"),
+        resource["url"],
+        entry["fullUrl"],
+        resource.get("version"))
+
+
+def download_resource(resource_type: str, r: BundleResponse, target_abspath: str, *,
+                      pretty: bool = False, etags: Dict[str, Dict[str, str]] = None, conditional: bool = True,
+                      session: requests.Session = SESSION) -> str:
+    """download a resource from the fully-qualified url in r to target_abspath.
+    The response body is stored unchanged, unless pretty is set.
+    If the ETag of the resource is known from a previous backup, the resource is only downloaded if it changed,
+    and the previous file is linked otherwise
+
+    Args:
+        resource_type (str): the resource type, used to look up the ETag
         r (BundleResponse): the parsed entry from the search bundle
-        out_dir (str): the output directory
+        target_abspath (str): the output path, see resource_filename
+        pretty (bool, optional): parse and re-indent the resource before writing it. Defaults to False.
+        etags (Dict[str, Dict[str, str]], optional): the ETags and paths of the previous backup,
+            keyed by resource type and id. Gets updated with this download. Defaults to None.
+        conditional (bool, optional): use the ETags to skip unchanged resources. Defaults to True.
+        session (requests.Session, optional): the session to use. Defaults to the shared SESSION.
+
+    Raises:
+        ValueError: if the status code is not 200 (or 304, for a conditional request)
 
     Returns:
         str: the fully-qualified output path
     """
-    rx = perform_request_as_json(r.url)
-
-    target_filename = f"{resource_type}-{r.resource_id}_{r.title}_{today}"
-    target_abspath = path.join(out_dir, slugify(target_filename)) + ".json"
-    with open(target_abspath, "w") as fs:
-        json.dump(rx, fs, indent=2)
+    etag_key = f"{resource_type}/{r.resource_id}"
+    previous = etags.get(etag_key) if etags is not None and conditional else None
+    if previous is not None and not path.isfile(previous["path"]):
+        previous = None
+    headers = {"If-None-Match": previous["etag"]} if previous is not None else None
+
+    with session.get(r.url, headers=headers, stream=True, timeout=(5, 30)) as rx:
+        if rx.status_code == 304 and previous is not None:
+            link_previous_backup(previous["path"], target_abspath)
+        elif rx.status_code != 200:
+            raise ValueError(
+                f"HTTP Error {rx.status_code} getting from {r.url}", rx)
+        else:
+            write_response_to_file(rx, target_abspath, pretty)
+        etag = rx.headers.get("ETag")
+    if etags is not None and etag:
+        etags[etag_key] = {"etag": etag, "path": target_abspath}
     sys.stdout.flush()
     return target_abspath
 
 
+def write_response_to_file(rx: requests.Response, target_abspath: str, pretty: bool = False):
+    """write the body of a response to target_abspath.
+    The body is written to a temporary file first, which then replaces the target. Thus, a failed download never
+    leaves a truncated file behind, and a target that is hard-linked to a previous backup is not modified
+
+    Args:
+        rx (requests.Response): the streamed response
+        target_abspath (str): the file to write to
+        pretty (bool, optional): parse and re-indent the body before writing it. Defaults to False.
+    """
+    temp_abspath = target_abspath + ".tmp"
+    try:
+        if pretty:
+            with open(temp_abspath, "wb") as fs:
+                fs.write(dump_json_pretty(response_as_json(rx)))
+        else:
+            rx.raw.decode_content = True
+            with open(temp_abspath, "wb") as fs:
+                shutil.copyfileobj(rx.raw, fs, length=1 << 20)
+        os.replace(temp_abspath, target_abspath)
+    except BaseException:
+        if path.exists(temp_abspath):
+            os.remove(temp_abspath)
+        raise
+
+
+def resource_filename(r: BundleResponse, filename_prefix: str, filename_suffix: str) -> str:
+    """build the output filename of a resource
+
+    Args:
+        r (BundleResponse): the parsed entry from the search bundle
+        filename_prefix (str): the start of the filename, '{resource_type}-'
+        filename_suffix (str): the end of the filename, '_{today}'
+
+    Returns:
+        str: the slugified filename, with the .json extension
+    """
+    return slugify(f"{filename_prefix}{r.resource_id}_{r.title}{filename_suffix}") + ".json"
+
+
+def link_previous_backup(previous_abspath: str, target_abspath: str):
+    """hard-link the file of an unchanged resource from a previous backup to the target path.
+    If the file cannot be linked, e.g. because the backups are on different file systems, it is copied instead
+
+    Args:
+        previous_abspath (str): the file of the previous backup
+        target_abspath (str): the path in the current backup
+    """
+    if path.exists(target_abspath):
+        if path.samefile(previous_abspath, target_abspath):
+            return
+        os.remove(target_abspath)
+    try:
+        os.link(previous_abspath, target_abspath)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+        # copies within the kernel where possible (sendfile on Linux, fcopyfile on macOS)
+        shutil.copyfile(previous_abspath, target_abspath)
+
+
+def load_etags(out_dir: str) -> Dict[str, Dict[str, str]]:
+    """load the ETags recorded by previous backups in out_dir
+
+    Args:
+        out_dir (str): the output directory
+
+    Returns:
+        Dict[str, Dict[str, str]]: the ETag and path of each resource, keyed by resource type and id
+    """
+    etags_path = path.join(out_dir, ETAGS_FILENAME)
+    if not path.isfile(etags_path):
+        return {}
+    with open(etags_path, "rb") as fs:
+        return json.load(fs)
+
+
+def save_etags(out_dir: str, etags: Dict[str, Dict[str, str]]):
+    """store the ETags in out_dir, replacing the previous file only once it is completely written
+
+    Args:
+        out_dir (str): the output directory
+        etags (Dict[str, Dict[str, str]]): the ETag and path of each resource, keyed by resource type and id
+    """
+    etags_path = path.join(out_dir, ETAGS_FILENAME)
+    with open(etags_path + ".tmp", "wb") as fs:
+        fs.write(dump_json_pretty(etags))
+    os.replace(etags_path + ".tmp", etags_path)
+
+
 def slugify(value, allow_unicode=False):
     """
     Convert to ASCII if 'allow_unicode' is False. Convert spaces or repeated
@@ -209,34 +491,61 @@ def slugify(value, allow_unicode=False):
     via https://stackoverflow.com/a/295466
     """
     value = str(value)
-    if allow_unicode:
+    # normalizing does not change ASCII strings
+    if value.isascii():
+        pass
+    elif allow_unicode:
         value = unicodedata.normalize('NFKC', value)
     else:
         value = unicodedata.normalize('NFKD', value).encode(
             'ascii', 'ignore').decode('ascii')
-    value = re.sub(r'[^\w\s-]', '', value.lower())
-    return re.sub(r'[-\s]+', '-', value).strip('-_')
+    value = value.lower()
+    if value.isascii():
+        value = value.translate(_SLUG_STRIP_ASCII)
+    else:
+        value = _SLUG_STRIP.sub('', value)
+    return _SLUG_DASH.sub('-', value).strip('-_')
 
 
-def remove_old_directories():
+def remove_old_directories(out_dir: str, delete_days: int, *, today: str = None):
+    """remove the backups in out_dir that are at least delete_days old
+
+    Args:
+        out_dir (str): the output directory, containing one folder per day
+        delete_days (int): the minimum age in days of the folders to remove, 0 for no removal
+        today (str, optional): the date of the current backup. Defaults to None, for today's date.
+    """
+    today = today or date.today().isoformat()
     print("\n\n########\n\n")
     print("REMOVING")
-    if args.delete_days <= 0:
+    if delete_days <= 0:
         print("No directories were removed")
         return
-    print(f"Removing from {args.out_dir}, >= {args.delete_days} ago")
-    folder_names = sorted(listdir(args.out_dir))
+    print(f"Removing from {out_dir}, >= {delete_days} ago")
     today_date = date.fromisoformat(today)
-    cutoff_date = today_date - timedelta(days=args.delete_days)
+    cutoff_date = today_date - timedelta(days=delete_days)
     print("Cutoff Date:", cutoff_date)
-    to_delete = [
-        fn for fn in folder_names if date.fromisoformat(fn) <= cutoff_date]
+    to_delete = []
+    with os.scandir(out_dir) as it:
+        for entry in it:
+            # only consider directories named for a date, as created by download_all_resource_types
+            match = _DATE_DIRECTORY.fullmatch(entry.name)
+            if match is None or not entry.is_dir(follow_symlinks=False):
+                continue
+            try:
+                folder_date = date(int(match[1]), int(match[2]), int(match[3]))
+            except ValueError:
+                continue
+            if folder_date <= cutoff_date:
+                to_delete.append(entry.name)
+    to_delete.sort()
     print("These folders will be deleted:", to_delete)
     for fn in to_delete:
-        full_path = path.abspath(path.join(args.out_dir, fn))
+        full_path = path.abspath(path.join(out_dir, fn))
         print(f" - {fn}: ", end='')
         try:
-            print(f"{len(listdir(full_path))} sub-directories", end='')
+            with os.scandir(full_path) as it:
+                print(f"{sum(1 for _ in it)} sub-directories", end='')
             shutil.rmtree(full_path)
             print(" -- deleted")
         except PermissionError:
@@ -245,32 +554,59 @@ def remove_old_directories():
             error_print(f"***Permission Error for '{full_path}': {permissions}")
 
 
-def download_all_resource_types():
-    """main entry point into the app"""
-    for resource_type in args.resource_types:
+def download_all_resource_types(endpoint: str, resource_types: List[str], out_dir: str, *,
+                                session: requests.Session = SESSION, parallel: int = 1, today: str = None,
+                                page_size: int = 0, pretty: bool = False, conditional: bool = True):
+    """download all resources of the given types from the server to a folder for today in out_dir
+
+    Args:
+        endpoint (str): the FHIR endpoint of the server
+        resource_types (List[str]): the resource types to back-up
+        out_dir (str): the output directory
+        session (requests.Session, optional): the session to use. Defaults to the shared SESSION.
+        parallel (int, optional): the number of parallel downloads. Defaults to 1.
+        today (str, optional): the date of the backup. Defaults to None, for today's date.
+        page_size (int, optional): the number of entries to request per bundle. Defaults to 0, for the server default.
+        pretty (bool, optional): parse and re-indent the resources before writing them. Defaults to False.
+        conditional (bool, optional): link the resources that are unchanged since the previous backup,
+            instead of downloading them. Defaults to True.
+    """
+    today = today or date.today().isoformat()
+    etags = load_etags(out_dir)
+    for resource_type in resource_types:
         print("\n\n########\n\n")
-        resource_list = get_resource_urls_from_server(
-            args.endpoint, resource_type, args.headers)
+        resource_list = get_resource_urls_from_server(endpoint, resource_type, page_size, session)
         print(f"got {len(resource_list)} resources of type {resource_type}")
         if len(resource_list) == 0:
             continue
-        out_dir = path.join(path.abspath(args.out_dir), today, resource_type)
-        if not (path.isdir(out_dir)):
-            makedirs(out_dir)
-        print(f"downloading with {args.parallel} parallel execution(s)")
-        if args.parallel == 1:
+        type_out_dir = path.join(path.abspath(out_dir), today, resource_type)
+        if not (path.isdir(type_out_dir)):
+            makedirs(type_out_dir)
+        # the parts of the output path that are the same for all resources of this type
+        out_dir_prefix = path.join(type_out_dir, "")
+        filename_prefix = f"{resource_type}-"
+        filename_suffix = f"_{today}"
+
+        def download(r: BundleResponse) -> str:
+            target_abspath = out_dir_prefix + resource_filename(r, filename_prefix, filename_suffix)
+            return download_resource_to_file(resource_type, r, target_abspath, pretty=pretty,
+                                             etags=etags, conditional=conditional, session=session)
+
+        print(f"downloading with {parallel} parallel execution(s)")
+        if parallel == 1:
             for r in resource_list:
-                download_resource_to_file(resource_type, r, out_dir)
+                download(r)
                 sys.stdout.flush()
         else:
-            pool = mp.Pool(args.parallel)
-            [pool.apply(download_resource_to_file, args=(resource_type, r, out_dir)) for r in resource_list]
-            pool.close()
+            # downloads are I/O-bound, so threads give real concurrency and share the session's connection pool
+            with ThreadPoolExecutor(max_workers=parallel) as executor:
+                list(executor.map(download, resource_list))
+        save_etags(out_dir, etags)
         sys.stdout.flush()
 
 
-def download_resource_to_file(resource_type: str, r: BundleResponse, out_dir: str):
-    fn = download_resource(resource_type, r, out_dir)
+def download_resource_to_file(resource_type: str, r: BundleResponse, target_abspath: str, **kwargs) -> str:
+    fn = download_resource(resource_type, r, target_abspath, **kwargs)
     print(f"   - {r.url} (canonical {r.canonical_url}) -> {fn}")
     sys.stdout.flush()
     return fn
@@ -281,20 +617,146 @@ def error_print(*the_args, **the_kwargs):
     print(*the_args, file=sys.stderr, **the_kwargs)
 
 
-def create_tarball():
-    """create a tarball for the downloaded files"""
-    if not args.tarball:
-        return
+def create_tarball(out_dir: str, *, today: str = None):
+    """create a tarball for the files downloaded today.
+    The tar stream is compressed with pigz on all cores if it is available, else with gzip in streaming mode
+
+    Args:
+        out_dir (str): the output directory, containing one folder per day
+        today (str, optional): the date of the backup. Defaults to None, for today's date.
+    """
+    today = today or date.today().isoformat()
     print("\n\n########\n\n")
-    output_path = path.join(path.abspath(args.out_dir), today)
+    output_path = path.join(path.abspath(out_dir), today)
     tar_filename = f"{today}.tar.gz"
     tar_path = path.join(output_path, tar_filename)
     print(f"creating tarball at {tar_path}")
-    file_list = sorted([path.join(output_path, f) for f in listdir(output_path) if f != tar_filename])
-    with tarfile.open(tar_path, "w:gz") as tar:
+    file_list = sorted([path.join(output_path, f) for f in listdir(output_path)
+                        if path.abspath(path.join(output_path, f)) != tar_path])
+    pigz = shutil.which("pigz")
+    try:
+        with open(tar_path, "wb") as tar_file:
+            if pigz is None:
+                print("pigz not found, compressing with gzip")
+                with tarfile.open(fileobj=tar_file, mode="w|gz") as tar:
+                    add_files_to_tarball(tar, file_list, today)
+                return
+            print("compressing with pigz")
+            process = subprocess.Popen([pigz, "-p", str(os.cpu_count() or 1)],
+                                       stdin=subprocess.PIPE, stdout=tar_file)
+            try:
+                with tarfile.open(fileobj=process.stdin, mode="w|") as tar:
+                    add_files_to_tarball(tar, file_list, today)
+            finally:
+                # always let pigz finish, so that no child process is left behind
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+                process.wait()
+            if process.returncode != 0:
+                raise RuntimeError(f"pigz exited with code {process.returncode} writing {tar_path}")
+    except BaseException:
+        # do not leave a partial tarball behind
+        if path.exists(tar_path):
+            os.remove(tar_path)
+        raise
+
+
+def add_files_to_tarball(tar: tarfile.TarFile, file_list: List[str], today: str):
+    """add the files (or directories) in file_list to the tarball, below a folder named for today.
+    Small files are read on a separate thread, so that reading from disk overlaps with compressing and writing.
+    Files larger than TARBALL_READ_AHEAD_MAX_SIZE are streamed from disk when they are added
+
+    Args:
+        tar (tarfile.TarFile): the open tarball
+        file_list (List[str]): the paths to add
+        today (str): the date of the backup, used as the folder name in the tarball
+    """
+    # bounded, so that the reader is never more than a few files (of at most TARBALL_READ_AHEAD_MAX_SIZE) ahead
+    members: queue.Queue = queue.Queue(maxsize=16)
+    stop = threading.Event()
+    reader = threading.Thread(target=read_tarball_members, args=(tar, file_list, today, members, stop), daemon=True)
+    reader.start()
+    try:
+        while True:
+            member = members.get()
+            if member is None:
+                break
+            if isinstance(member, BaseException):
+                raise member
+            tarinfo, content, file_path = member
+            if content is not None:
+                tar.addfile(tarinfo, io.BytesIO(content))
+            elif tarinfo.isreg():
+                with open(file_path, "rb") as fs:
+                    tar.addfile(tarinfo, fs)
+            else:
+                tar.addfile(tarinfo)
+            if tarinfo.name.count("/") == 1:
+                print(f" - adding {tarinfo.name} to tarball")
+    finally:
+        # if writing failed, the reader may be waiting on the full queue, so tell it to stop before joining
+        stop.set()
+        reader.join()
+
+
+def read_tarball_members(tar: tarfile.TarFile, file_list: List[str], today: str, members: queue.Queue,
+                         stop: threading.Event):
+    """read the headers and contents of the paths in file_list (recursively) into the members queue.
+    None is put after the last member, or the exception if reading failed
+
+    Args:
+        tar (tarfile.TarFile): the open tarball, used to create the headers
+        file_list (List[str]): the paths to add
+        today (str): the date of the backup, used as the folder name in the tarball
+        members (queue.Queue): receives tuples of the header, the content and the path. The content is None
+            for anything but regular files of at most TARBALL_READ_AHEAD_MAX_SIZE
+        stop (threading.Event): set by the consumer when it no longer takes members from the queue
+    """
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                members.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
         for f in file_list:
-            tar.add(f, arcname=f"{today}/{os.path.basename(f)}")
-            print(f" - added {f} to tarball")
+            parent = path.dirname(f)
+            for file_path in iterate_tarball_paths(f):
+                tarinfo = tar.gettarinfo(file_path, arcname=f"{today}/{path.relpath(file_path, parent)}")
+                content = None
+                if tarinfo.isreg() and tarinfo.size <= TARBALL_READ_AHEAD_MAX_SIZE:
+                    with open(file_path, "rb") as fs:
+                        content = fs.read()
+                if not put((tarinfo, content, file_path)):
+                    return
+    except BaseException as e:
+        put(e)
+        return
+    put(None)
+
+
+def iterate_tarball_paths(root: str) -> Iterator[str]:
+    """walk through root in sorted order, yielding every directory before its contents
+
+    Args:
+        root (str): the file or directory to walk through
+
+    Returns:
+        Iterator[str]: the paths of root and everything below it
+    """
+    if not path.isdir(root) or path.islink(root):
+        yield root
+        return
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names.sort()
+        yield dir_path
+        for file_name in sorted(file_names):
+            yield path.join(dir_path, file_name)
 
 
 if __name__ == "__main__":
@@ -303,7 +765,11 @@ if __name__ == "__main__":
     print(f"executing at {datetime.now().isoformat()} UTC")
     print("------------------------------------------")
     args = parse_args()
-    download_all_resource_types()
-    create_tarball()
-    remove_old_directories()
+    configure_session(args.parallel, args.headers)
+    download_all_resource_types(args.endpoint, args.resource_types, args.out_dir,
+                                parallel=args.parallel, today=today, page_size=args.page_size, pretty=args.pretty,
+                                conditional=not args.full)
+    if args.tarball:
+        create_tarball(args.out_dir, today=today)
+    remove_old_directories(args.out_dir, args.delete_days, today=today)
     print("##########################################\n\n")
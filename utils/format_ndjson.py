@@ -1,9 +1,6 @@
-from ast import arg
 import html
-import ndjson
+import json
 import argparse
-from yattag import Doc, indent
-from datetime import date, datetime
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--in", "-i", type=str, dest="in_file", required=True)
@@ -11,23 +8,10 @@ parser.add_argument("--out", "-o", type=str, dest="out_file", required=True)
 parser.add_argument("--title", "-t", type=str, required=True)
 args = parser.parse_args()
 
-now = datetime.now().isoformat()
-
-with open(args.in_file.strip(), "r") as ndf:
-  data = ndjson.load(ndf)
-
-doc, tag, text, line = Doc().ttl()
-with (tag('html')):
-  with tag('head'):
-    doc.stag(
-      'link', 
-      rel='stylesheet', 
-      href='https://unpkg.com/purecss@2.1.0/build/pure-min.css', 
-      integrity='sha384-yHIFVG6ClnONEA5yB5DJXfW2/KC173DIQrYoZMEtBvGzmf0PKiGyNEqe9N6BNDBH', 
-      crossorigin='anonymous'
-    )
-    with tag('style'):
-      text("""
+HEAD = """<html>
+  <head>
+    <link rel="stylesheet" href="https://unpkg.com/purecss@2.1.0/build/pure-min.css" integrity="sha384-yHIFVG6ClnONEA5yB5DJXfW2/KC173DIQrYoZMEtBvGzmf0PKiGyNEqe9N6BNDBH" crossorigin="anonymous" />
+    <style>
       table {
         table-layout: fixed;
         width: 100%;
@@ -35,30 +19,54 @@ with (tag('html')):
       td {
         word-wrap: break-word;
       }
-      """)
-  with tag('body'):
-    with tag('div', klass='pure-g'):
-      with tag('div', klass='pure-u-1'):
-        line('h2', args.title)
+    </style>
+  </head>
+  <body>
+    <div class="pure-g">
+      <div class="pure-u-1">
+        <h2>{title}</h2>
+      </div>
+      <div class="pure-u-1">
+        <table class="pure-table pure-table-striped pure-table-bordered">
+"""
+
+FOOT = """          </tbody>
+        </table>
+      </div>
+    </div>
+  </body>
+</html>
+"""
+
+
+def escape(value) -> str:
+  if value is None:
+    return ""
+  return html.escape(str(value), quote=False)
+
+
+def header_row(row) -> str:
+  cells = "".join(f"<td><b><i>{escape(key)}</i></b></td>" for key in row.keys())
+  return f"          <thead>\n            <tr>{cells}</tr>\n          </thead>\n          <tbody>\n"
+
 
-      with tag('div', klass='pure-u-1'):
-        with tag('table', klass='pure-table pure-table-striped pure-table-bordered'):
-          with tag('thead'):
-            with tag('tr'):
-              for key in data[0].keys():
-                with tag('td'):
-                  with tag('b'):
-                    with tag('i'):
-                      text(key)
+def body_row(row) -> str:
+  cells = "".join(f"<td>{escape(value)}</td>" for value in row.values())
+  return f"            <tr>{cells}</tr>\n"
 
-          with tag('tbody'):
-            for row in data:
-              with tag('tr'):
-                for key in row.keys():
-                  with tag('td'):
-                    value = row[key]
-                    if value != None:
-                      text(row[key])
 
-with open(args.out_file, "w") as html_f:
-  html_f.write(indent(doc.getvalue()))
\ No newline at end of file
+# the rows are written as they are read, so the input is never held in memory as a whole
+with open(args.in_file.strip(), "r") as ndf, open(args.out_file, "w") as html_f:
+  html_f.write(HEAD.replace("{title}", escape(args.title)))
+  first = True
+  for line in ndf:
+    if not line.strip():
+      continue
+    row = json.loads(line)
+    if first:
+      html_f.write(header_row(row))
+      first = False
+    html_f.write(body_row(row))
+  if first:
+    html_f.write("          <tbody>\n")
+  html_f.write(FOOT)